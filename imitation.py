@@ -1,42 +1,149 @@
 import os
 import argparse
+import multiprocessing
 import numpy as np
 import keras
 import gym
 import matplotlib.pyplot as plt
 import tensorflow as tf
 
+ENV_NAME = 'LunarLander-v2'
+
+# Per-process state of the expert data-collection workers, set up by _init_expert_worker.
+_worker_imitation = None
+_worker_expert_step = None
+_worker_env = None
+
+
+def _init_expert_worker(args):
+    global _worker_imitation, _worker_expert_step, _worker_env
+    _worker_imitation = Imitation(args)
+    _worker_expert_step = _worker_imitation.policy_step('expert')
+    _worker_env = gym.make(ENV_NAME)
+
+
+def _run_expert_worker(seed):
+    """
+    Generates one expert episode in a worker process.
+    :param seed: the seed of the worker's env for this episode.
+    :return: the states and integer actions of the episode, as float32 and uint8 arrays.
+    """
+    _worker_env.seed(seed)
+    states, actions, _ = _worker_imitation.generate_episode(_worker_expert_step, _worker_env)
+    return np.asarray(states, dtype=np.float32), np.asarray(actions, dtype=np.uint8)
+
 
 class Imitation:
     def __init__(self, args):
-        # Load the expert model.
-        with open(args.model_config_path, 'r') as f:
-            self.expert = keras.models.model_from_json(f.read())
-        self.expert.load_weights(args.expert_weights_path)
-
-        # Initialize the cloned model (to be trained).
-        with open(args.model_config_path, 'r') as f:
-            self.model = keras.models.model_from_json(f.read())
+        self.model_config_path = args.model_config_path
+        self.expert_weights_path = args.expert_weights_path
 
         self.num_episodes = args.num_episodes
         self.num_epochs = args.num_epochs
         self.eval_episodes = args.eval_episodes
+        self.base_lr = args.base_lr
+        self.num_workers = args.num_workers
+        self.seed = args.seed
+        # Kept so that the data-collection workers can rebuild the models.
+        self._args = args
 
-        # Define any training operations and optimizers here, initialize your variables,
-        # or alternatively compile your model here.
-        self.model.compile(loss=keras.losses.categorical_crossentropy,
-                           optimizer=keras.optimizers.Adam(lr=args.base_lr, beta_1=0.9, beta_2=0.999, epsilon=None,
-                                                           decay=0.0, amsgrad=False),
-                           metrics=['acc'])
+        # The expert and the cloned model, together with their graph-compiled policy steps,
+        # are only built on first use, so that e.g. plotting does not construct any Keras model.
+        self._expert = None
+        self._model = None
+        self._policy_steps = {}
+        # Both models share one config, so the observation size is cached from whichever is loaded first.
+        self._obs_dim = None
+        # A persistent input tensor, so that each step writes into it instead of allocating a new one.
+        self._obs_tensor = None
+
+        # The cloned model is only compiled in train(), so that the inference-only
+        # paths (e.g. evaluate) run on an uncompiled model.
+
+    def _load_model(self):
+        with open(self.model_config_path, 'r') as f:
+            model = keras.models.model_from_json(f.read())
+        if self._obs_dim is None:
+            self._obs_dim = model.input_shape[-1]
+        return model
+
+    @property
+    def expert(self):
+        """The expert model, loaded with the expert weights on first access."""
+        if self._expert is None:
+            self._expert = self._load_model()
+            self._expert.load_weights(self.expert_weights_path)
+        return self._expert
 
-    def run_expert(self, env, render=False):
+    @property
+    def model(self):
+        """The cloned model (to be trained), initialized on first access."""
+        if self._model is None:
+            self._model = self._load_model()
+        return self._model
+
+    def policy_step(self, which, batch_size=1):
         """
-        Generates an episode by running the expert policy on the given env.
-        :param env: 
-        :param render: 
-        :return: 
+        Returns the graph-compiled greedy policy of the expert or the cloned model,
+        building it on first use for each batch size.
+        :param which: either 'expert' or 'model'.
+        :param batch_size: # states per call, or None to accept any batch size (e.g. whole episodes).
+        :return: a callable mapping a (batch_size, obs_dim) batch of states to a (batch_size,) tensor of actions.
+        """
+        key = (which, batch_size)
+        if key not in self._policy_steps:
+            self._policy_steps[key] = self._build_policy_step(getattr(self, which), batch_size)
+        return self._policy_steps[key]
+
+    def _build_policy_step(self, model, batch_size):
+        """
+        Builds a graph function selecting the greedy action of the given model.
+        The input signature is fixed so the function is traced only once. For a fixed batch size
+        the forward pass is also compiled with XLA to fuse the dense layers; with a variable batch
+        size it is not, since XLA would compile it again for every new shape.
+        :param model: 
+        :param batch_size: # states per call, or None to accept any batch size.
+        :return: a callable mapping a (batch_size, obs_dim) batch of states to a (batch_size,) tensor of actions.
+        """
+        obs_dim = model.input_shape[-1]
+
+        @tf.function(jit_compile=batch_size is not None,
+                     input_signature=[tf.TensorSpec([batch_size, obs_dim], tf.float32)])
+        def step(obs):
+            return tf.argmax(model(obs, training=False), axis=-1, output_type=tf.int32)
+        # Warm up once so the tracing and XLA compile time is not charged to the first episode.
+        step(tf.zeros([batch_size or 1, obs_dim], dtype=tf.float32))
+        return step
+
+    def run_expert(self, env):
         """
-        return Imitation.generate_episode(self.expert, env, render)
+        Generates one episode per sub-env by running the expert policy on the given vectorized env.
+        The expert acts on all sub-envs with a single batched forward pass per step.
+        :param env: a gym.vector env.
+        :return: a list of (states, actions, rewards) episodes, one per sub-env,
+            where actions are integer action indices.
+        """
+        num_envs = env.num_envs
+        states = [[] for _ in range(num_envs)]
+        actions = [[] for _ in range(num_envs)]
+        rewards = [[] for _ in range(num_envs)]
+        active = np.ones(num_envs, dtype=bool)
+        policy = self.policy_step('expert', num_envs)
+
+        obs = env.reset()
+        while active.any():
+            action = policy(np.asarray(obs, dtype=np.float32)).numpy()
+            next_obs, reward, done, _ = env.step(action)
+            # Finished sub-envs are reset automatically by the vector env, so ignore
+            # their transitions until every sub-env has completed its episode.
+            for i in np.flatnonzero(active):
+                states[i].append(obs[i])
+                actions[i].append(action[i])
+                rewards[i].append(reward[i])
+            active &= ~done
+            obs = next_obs
+
+        return [(states[i], actions[i], rewards[i]) for i in range(num_envs)]
 
     def run_model(self, env, render=False):
         """
@@ -45,30 +152,31 @@ class Imitation:
         :param render: 
         :return: 
         """
-        states, _, rewards = Imitation.generate_episode(self.model, env, render)
-        expert_actions = []
-        for s in states:
-            one_hot_expert_action = np.zeros(env.action_space.n)
-            one_hot_expert_action[np.argmax(self.expert.predict(np.expand_dims(s, axis=0)))] = 1
-            expert_actions.append(one_hot_expert_action)
+        states, _, rewards = self.generate_episode(self.policy_step('model'), env, render)
+        # Relabel all visited states with a single batched forward pass of the expert.
+        states_arr = np.asarray(states, dtype=np.float32)
+        expert_actions = self.policy_step('expert', None)(states_arr).numpy().astype(np.uint8)
         return states, expert_actions, rewards
 
-    @staticmethod
-    def generate_episode(model, env, render=False):
+    def generate_episode(self, policy, env, render=False):
         """
-        Generates an episode by running the given model on the given env.
-        :param model: 
+        Generates an episode by running the given policy on the given env.
+        :param policy: a policy_step callable mapping a (1, obs_dim) batch of states to a (1,) tensor of actions.
         :param env: 
         :param render: 
         :return: 
             - a list of states, indexed by time step
-            - a list of actions, indexed by time step
+            - a list of integer actions, indexed by time step
             - a list of rewards, indexed by time step
         """
         states = []     # (episode_length, 8)
-        actions = []    # (episode_length, 8) -> one-hot encoding
+        actions = []    # (episode_length,) -> integer action indices
         rewards = []    # (episode_length,)
 
+        # the policy comes from policy_step, so a model has been loaded and obs_dim is known
+        if self._obs_tensor is None:
+            self._obs_tensor = tf.Variable(tf.zeros([1, self._obs_dim], dtype=tf.float32), trainable=False)
+
         state = env.reset()
         done = False
 
@@ -76,38 +184,77 @@ class Imitation:
             env.render()
 
         while not done:
-            action = np.argmax(model.predict(np.expand_dims(state, axis=0)))
-            one_hot_action = np.zeros(env.action_space.n)
-            one_hot_action[action] = 1.
+            self._obs_tensor.assign(state[None, :])
+            action = policy(self._obs_tensor).numpy().item()
             states.append(state)
-            actions.append(one_hot_action)
+            actions.append(action)
             state, reward, done, _ = env.step(action)
             if render:
                 env.render()
             rewards.append(reward)
         return states, actions, rewards
     
-    def train(self, env, log_dir, num_episodes=100, num_epochs=50, render=False):
+    def expert_episodes(self, env, num_episodes, render=False):
+        """
+        Generates expert episodes, either one at a time on a single rendered env (if render),
+        in a pool of worker processes (if num_workers > 0), each of which rebuilds the expert once,
+        or on the given vectorized env.
+        :param env: The environment to run the expert policy on: a single env if render,
+            otherwise a vectorized env, unused with workers.
+        :param num_episodes: # episodes to be generated by the expert.
+        :param render: Whether to render the environment.
+        :return: an iterator over (states, actions) episodes.
+        """
+        if render:
+            # vector envs cannot render, so fall back to running the expert episode by episode
+            policy = self.policy_step('expert')
+            for _ in range(num_episodes):
+                states, actions, rewards = self.generate_episode(policy, env, render)
+                yield states, actions
+        elif self.num_workers > 0:
+            # spawn rather than fork, since the parent has already initialized TensorFlow
+            ctx = multiprocessing.get_context('spawn')
+            with ctx.Pool(self.num_workers, initializer=_init_expert_worker, initargs=(self._args,)) as pool:
+                seeds = range(self.seed, self.seed + num_episodes)
+                for states, actions in pool.imap_unordered(_run_expert_worker, seeds):
+                    yield states, actions
+        else:
+            episodes = 0
+            while episodes < num_episodes:
+                for states, actions, rewards in self.run_expert(env)[:num_episodes - episodes]:
+                    yield states, actions
+                    episodes += 1
+
+    def train(self, env, log_dir, max_episode_steps, num_episodes=100, num_epochs=50, render=False):
         """
         Trains the model on training data generated by the expert policy.
-        :param env: The environment to run the expert policy on. 
+        :param env: The environment to run the expert policy on: a single env if render,
+            otherwise a vectorized env, unused with workers. 
         :param log_dir: 
+        :param max_episode_steps: the time limit of an episode of env, which bounds the training data.
         :param num_episodes: # episodes to be generated by the expert.
         :param num_epochs: # epochs to train on the data generated by the expert.
         :param render: Whether to render the environment.
         :return: the final loss and accuracy.
         """
-        train_states = np.zeros([0, env.observation_space.shape[0]], dtype=float)
-        train_actions = np.zeros([0, env.action_space.n], dtype=int)
+        # stream the expert episodes straight into preallocated arrays as they complete
+        max_len = num_episodes * max_episode_steps
+        train_x = np.empty((max_len, self.model.input_shape[-1]), dtype=np.float32)
+        train_y = np.empty((max_len,), dtype=np.uint8)
+        n = 0
+        for states, actions in self.expert_episodes(env, num_episodes, render):
+            train_x[n:n + len(states)] = states
+            train_y[n:n + len(actions)] = actions
+            n += len(states)
 
-        # get training data from expert
-        for j in range(num_episodes):
-            states, actions, rewards = self.run_expert(env, render)
-            train_states = np.concatenate([train_states, np.array(states)], axis=0)
-            train_actions = np.concatenate([train_actions, np.array(actions)], axis=0)
-
-        # train current model from training data
-        history = self.model.fit(train_states, train_actions, batch_size=32, epochs=num_epochs, verbose=1)
+        # train current model from training data, using integer labels with a sparse loss
+        dataset = tf.data.Dataset.from_tensor_slices((train_x[:n], train_y[:n]))
+        dataset = dataset.shuffle(n).batch(32).prefetch(tf.data.AUTOTUNE)
+        self.model.compile(loss=keras.losses.sparse_categorical_crossentropy,
+                           optimizer=keras.optimizers.Adam(lr=self.base_lr, beta_1=0.9, beta_2=0.999, epsilon=None,
+                                                           decay=0.0, amsgrad=False),
+                           metrics=['acc'])
+        history = self.model.fit(dataset, epochs=num_epochs, verbose=1)
 
         # save model and weights
         if not os.path.isdir('model'):
@@ -118,39 +265,58 @@ class Imitation:
         # save loss
         if not os.path.isdir('loss'):
             os.mkdir('loss')
-        loss_name = "loss/{}.txt".format(log_dir)
-        with open(loss_name, 'w') as file_to_write:
-            file_to_write.write("{}".format(','.join(str(k) for k in history.history['loss'])))
+        loss_name = "loss/{}.npy".format(log_dir)
+        np.save(loss_name, np.asarray(history.history['loss']))
 
         # save accuracy
         if not os.path.isdir('acc'):
             os.mkdir('acc')
-        acc_name = "acc/{}.txt".format(log_dir)
-        with open(acc_name, 'w') as file_to_write:
-            file_to_write.write("{}".format(','.join(str(k) for k in history.history['acc'])))
+        acc_name = "acc/{}.npy".format(log_dir)
+        np.save(acc_name, np.asarray(history.history['acc']))
 
         return history.history['loss'][0], history.history['acc'][0]
 
-    def evaluate(self, env, log_dir, render=False):
+    def total_rewards(self, policy, env):
+        """
+        Runs one episode per sub-env of the given vectorized env with a batched policy.
+        :param policy: a callable mapping a (num_envs, obs_dim) batch of states to a (num_envs,) tensor of actions.
+        :param env: a gym.vector env.
+        :return: an array of the total reward of each sub-env's episode.
+        """
+        cum_rewards = np.zeros(env.num_envs)
+        active = np.ones(env.num_envs, dtype=bool)
+
+        obs = env.reset()
+        while active.any():
+            action = policy(np.asarray(obs, dtype=np.float32)).numpy()
+            obs, reward, done, _ = env.step(action)
+            # sub-envs that are already done keep being stepped (and reset), but no longer count
+            cum_rewards += reward * active
+            active &= ~done
+        return cum_rewards
+
+    def evaluate(self, env, log_dir):
+        """
+        Evaluates the saved cloned policy on one episode per sub-env of the given env.
+        :param env: a gym.vector env with eval_episodes sub-envs.
+        :param log_dir: 
+        """
         self.model.load_weights("model/{}.h5".format(log_dir))
-        cum_rewards = np.zeros(self.eval_episodes)
-        for i in range(self.eval_episodes):
-            _, _, rewards = self.generate_episode(self.model, env, render=False)
-            cum_rewards[i] = np.sum(rewards)
+        cum_rewards = self.total_rewards(self.policy_step('model', env.num_envs), env)
         print("Policy: %s Cumulative rewards: mean: %f std: %f" % (log_dir, cum_rewards.mean(), cum_rewards.std()))
 
     @staticmethod
     def plot(log_dir):
-        loss_name = "loss/{}.txt".format(log_dir)
-        loss_list = np.loadtxt(loss_name, delimiter=',')
+        loss_name = "loss/{}.npy".format(log_dir)
+        loss_list = np.load(loss_name)
         plt.plot(loss_list)
         plt.title('training loss')
         plt.ylabel('loss')
         plt.xlabel('number of epochs')
         plt.show()
 
-        acc_name = "acc/{}.txt".format(log_dir)
-        acc_list = np.loadtxt(acc_name, delimiter=',')
+        acc_name = "acc/{}.npy".format(log_dir)
+        acc_list = np.load(acc_name)
         plt.plot(acc_list)
         plt.title('training accuracy')
         plt.ylabel('accuracy')
@@ -169,6 +335,10 @@ def parse_arguments():
     parser.add_argument('--plot', action='store_true', help='turn on plotting')
     parser.add_argument('--num_epochs', type=int, default=100, help='number of epochs for training')
     parser.add_argument('--eval_episodes', type=int, default=50, help='number of evaluation episodes')
+    parser.add_argument('--num_envs', type=int, default=8, help='number of parallel envs to run the expert on')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='number of worker processes generating expert data (0 to use the parallel envs instead)')
+    parser.add_argument('--seed', type=int, default=666, help='random seed for the environments')
     parser.add_argument('--base_lr', type=float, default=0.001, help='initial learning rate')
     parser.add_argument('--model-config-path', dest='model_config_path', type=str, default='LunarLander-v2-config.json',
                         help="Path to the model config file.")
@@ -186,15 +356,29 @@ def parse_arguments():
 
 
 def main(args):
-    # Create the environment.
-    env = gym.make('LunarLander-v2')
-
     imitation = Imitation(args)
 
     if args.train:
-        imitation.train(env, args.log_dir, args.num_episodes, args.num_epochs, args.render)
+        # Run the expert on several envs stepped in parallel subprocesses, unless the data
+        # comes from worker processes (which create their own envs) or has to be rendered.
+        env = None
+        if args.render:
+            # Vector envs cannot render, so the expert runs on a single rendered env instead.
+            env = gym.make(ENV_NAME)
+        elif args.num_workers == 0:
+            env = gym.vector.AsyncVectorEnv([lambda: gym.make(ENV_NAME) for _ in range(args.num_envs)])
+        if env is not None:
+            env.seed(args.seed)
+        max_episode_steps = gym.spec(ENV_NAME).max_episode_steps
+        imitation.train(env, args.log_dir, max_episode_steps, args.num_episodes, args.num_epochs, args.render)
+        if env is not None:
+            env.close()
     elif args.test:
-        imitation.evaluate(env, args.log_dir, args.eval_episodes)
+        # Run all evaluation episodes side by side, with one batched forward pass per step.
+        env = gym.vector.SyncVectorEnv([lambda: gym.make(ENV_NAME) for _ in range(args.eval_episodes)])
+        env.seed(args.seed)
+        imitation.evaluate(env, args.log_dir)
+        env.close()
     elif args.plot:
         imitation.plot(args.log_dir)
 